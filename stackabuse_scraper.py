@@ -1,148 +1,435 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import requests
-import json
+import aiohttp
+import orjson
 import csv
 import time
+import asyncio
+import os
+import re
+import sys
 import logging
+import functools
 import pathlib
-from slugify import slugify
-from bs4 import BeautifulSoup
+from slugify import slugify as unicode_slugify
+from lxml import etree
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 
 BASE_URL = 'https://stackabuse.com'
+# Maximum number of requests in flight to Stack Abuse at once
+CONCURRENCY = 10
+# Maximum number of requests started per second
+RATE_LIMIT = 2
+# Keep-alive connections pooled by the session, shared by every request
+POOL_SIZE = 20
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36',
+    'Accept-Encoding': 'gzip, deflate',
+}
+# Validators and scraped data of article pages, for conditional requests
+CACHE_FILE = 'etag_cache.json'
 
+# Runs of characters that are not allowed in an ASCII slug
+SLUG_SEPARATORS = re.compile(r'[^a-z0-9]+')
+# Thousands separators, dropped so "1,000" stays "1000" like python-slugify
+SLUG_NUMBER_COMMAS = re.compile(r'(?<=\d),(?=\d)')
 
-def parse_page(page_url):
+# Front matter and body of the Hexo articles, written in one go per post
+MARKDOWN_TEMPLATE = '''---
+title: "{title}"
+date: {date}
+link: {link}
+author: {author}
+editor: {editor}
+description: "{description}"
+tags: [{tags}]
+---
+
+{content}
+'''
+
+# Selectors are compiled to XPath once on import rather than on every page
+ARTICLES = CSSSelector('div.p-6')
+ARTICLE_LINK = CSSSelector(r'a.block.hover\:no-underline')
+ARTICLE_TITLE = CSSSelector('h3')
+ARTICLE_DATE = CSSSelector('div.mt-6.flex.items-center time')
+ARTICLE_AUTHOR = CSSSelector(r'div.mt-6.flex.items-center a.hover\:underline')
+# XPath test for a whole class token, so "pl-1" does not match "pl-10"
+HAS_CLASS = 'contains(concat(" ", normalize-space(@class), " "), " {} ")'
+# The pagination bar: a nav labelled as such, or the first nav after the
+# last article, so links in the site header are never taken for it
+PAGINATION_BAR = (
+    '//nav[@aria-label="Pagination"]'
+    ' | (//div[{}])[last()]/following::nav[1]'.format(HAS_CLASS.format('p-6')))
+# Link to the older posts, tried in order until one matches: stable
+# attributes first, then the bar's link text, then the Tailwind classes of
+# the bar's right-hand link
+PAGINATION = (
+    etree.XPath('//a[@rel="next"]'),
+    etree.XPath('//a[{}]'.format(HAS_CLASS.format('older-posts'))),
+    etree.XPath('({})//a[contains(., "Next") or contains(., "Older")]'.format(
+        PAGINATION_BAR)),
+    etree.XPath('//a[{} and {}]'.format(
+        HAS_CLASS.format('border-t-2'), HAS_CLASS.format('pl-1'))),
+)
+# Classes of the div holding an article's category links
+CATEGORY_CLASSES = {'mt-8', 'mb-4'}
+
+
+class AsyncRateLimiter:
+    '''Token bucket bounding how many requests start per second and how
+    many are in flight at once'''
+
+    def __init__(self, rate, concurrency, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.sem = asyncio.Semaphore(concurrency)
+
+    async def acquire_token(self):
+        '''Waits until a token is available and takes it'''
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+        try:
+            await self.acquire_token()
+        except BaseException:
+            self.sem.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.sem.release()
+
+
+def slugify(text):
+    '''Turns a title into a file name, transliterating only when needed'''
+    # python-slugify also decodes HTML entities, leave those titles to it
+    if not text.isascii() or '&' in text:
+        return unicode_slugify(text)
+    text = SLUG_NUMBER_COMMAS.sub('', text.lower())
+    return SLUG_SEPARATORS.sub('-', text).strip('-')
+
+
+def load_cache(filename):
+    '''Reads the conditional request cache, empty if there is none yet'''
+    try:
+        with open(filename, 'rb') as cache_file:
+            cache = orjson.loads(cache_file.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    # Share tag strings with freshly scraped pages, as PageScanner does
+    for entry in cache.values():
+        entry['data']['categories'] = tuple(
+            map(sys.intern, entry['data']['categories']))
+    return cache
+
+
+def save_cache(filename, cache):
+    '''Writes the conditional request cache for the next run'''
+    with open(filename, 'wb') as cache_file:
+        cache_file.write(orjson.dumps(cache))
+
+
+async def fetch(session, url, limiter):
+    '''Parses a page as it downloads, None if it could not be retrieved'''
+    async with limiter, session.get(url) as response:
+        if response.status != 200:
+            return None
+        # Feeding chunks as they arrive overlaps parsing with the download
+        # and never holds the whole body in memory. Comments and processing
+        # instructions are never read so they are left out of the tree
+        parser = lxml_html.HTMLParser(remove_comments=True, remove_pis=True)
+        async for chunk in response.content.iter_any():
+            parser.feed(chunk)
+        return parser.close()
+
+
+class PageScanner:
+    '''Collects the article data from parser events as the page streams in,
+    discarding the parts of the tree it has already looked at'''
+
+    def __init__(self):
+        self.description = None
+        self.categories = None
+        self.content = None
+        self.wrapper = None
+        self.paragraph = None
+
+    def done(self):
+        '''Whether every field has been found'''
+        return (self.description is not None and self.categories is not None
+                and self.content is not None)
+
+    def page_data(self):
+        '''The fields found so far, empty for the ones that were not'''
+        return {
+            'categories': self.categories or (),
+            'description': self.description or '',
+            'content': self.content or '',
+        }
+
+    def scan(self, events):
+        '''Consumes start/end events, returns True once every field is found'''
+        for event, elem in events:
+            if event == 'start':
+                if (elem.tag == 'meta' and self.description is None
+                        and elem.get('name') == 'description'):
+                    self.description = elem.get('content', '').strip()
+                elif (elem.tag == 'div' and self.categories is None
+                        and self.wrapper is None
+                        and CATEGORY_CLASSES <= set(elem.get('class', '').split())):
+                    self.wrapper = elem
+                elif (elem.tag == 'p' and self.content is None
+                        and self.paragraph is None):
+                    self.paragraph = elem
+            elif elem is self.wrapper:
+                # Tags repeat across posts, interning keeps one copy of each
+                self.categories = tuple(
+                    sys.intern(''.join(a.itertext()).replace('#', '').strip())
+                    for a in elem.iter('a'))
+                self.wrapper = None
+                elem.clear()
+            elif elem is self.paragraph:
+                self.content = ''.join(elem.itertext()).strip()
+                self.paragraph = None
+                elem.clear()
+            elif self.wrapper is None and self.paragraph is None:
+                # Nothing else is read from the page, so finished elements
+                # are emptied instead of building up the whole tree
+                elem.clear()
+        return self.done()
+
+
+async def parse_page(session, page_url, limiter, cache):
     '''Gets more data from the article page'''
     logging.info('Scraping {}'.format(page_url))
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
-    }
-    response = requests.get(page_url, headers=headers)
-    if response is not None and response.status_code == 200:
-        html = BeautifulSoup(response.content, 'html.parser')
-        category_wrapper = html.find('div', {'class': 'mt-8 mb-4'})
-        categories = map(lambda x: x.text.replace(
-            '#', '').strip(), category_wrapper.find_all('a'))
-        description_data = html.find_all(
-            'meta', attrs={'name': 'description'})
-        if len(description_data) > 0:
-            description = description_data[0].get('content').strip()
+    cached = cache.get(page_url)
+    headers = {}
+    if cached is not None:
+        if cached['etag'] is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified'] is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    scanner = PageScanner()
+    async with limiter, session.get(page_url, headers=headers) as response:
+        if response.status == 304 and cached is not None:
+            logging.info('{} has not changed'.format(page_url))
+            return cached['data']
+        elif response.status != 200:
+            # The post is still written with empty page data, and nothing is
+            # cached so the page is fetched again on the next run
+            logging.error('Could not get a response for {} ({})'.format(
+                page_url, response.status))
+            return scanner.page_data()
+
+        parser = etree.HTMLPullParser(
+            events=('start', 'end'), remove_comments=True, remove_pis=True)
+        async for chunk in response.content.iter_any():
+            parser.feed(chunk)
+            if scanner.scan(parser.read_events()):
+                break
         else:
-            description = ''
-        content = html.find_all('p')[0].text.strip()
+            parser.close()
+            scanner.scan(parser.read_events())
+        # The rest of the body is read without parsing it, so the connection
+        # can go back to the pool instead of being closed
+        async for _ in response.content.iter_any():
+            pass
 
-        return {
-            'categories': categories,
-            'description': description,
-            'content': content,
+    page_data = scanner.page_data()
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag is not None or last_modified is not None:
+        cache[page_url] = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'data': page_data,
         }
-    else:
-        logging.error('Could not get a response for the link')
-        return {}
+    return page_data
+
 
+def find_older_posts(doc):
+    '''Returns the link to the older posts, None on the last page'''
+    for pagination in PAGINATION:
+        links = pagination(doc)
+        if links:
+            return links[0].get('href')
+    return None
 
-def parse_posts(author_url, defaut_editor):
-    '''Recursively retrieves all the posts of an blog write in stack abuse'''
+
+async def parse_posts(session, author_url, defaut_editor, limiter, cache):
+    '''Yields all the posts of an blog write in stack abuse, page by page'''
     logging.info('Scraping {}'.format(author_url))
-    posts = []
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
-    }
-    response = requests.get(author_url, headers=headers)
-    if response is not None and response.status_code == 200:
-        html = BeautifulSoup(response.content, 'html.parser')
-        for article in html.find_all('div', {'class': 'p-6'}):
-            article_details = article.find(
-                'a', {'class': 'block hover:no-underline'})
-            title = article_details.find('h3').text.strip()
-            link = BASE_URL + article_details['href']
-            meta = article.find('div', {'class': 'mt-6 flex items-center'})
-            date_text = meta.find('time')['datetime'].strip()
-            author_data = meta.find('a', {'class': 'hover:underline'})
-            author = author_data.text.strip()
-
-            time.sleep(0.5)
-            page_data = parse_page(link)
-            logging.debug(page_data)
-
-            post = {
-                'title': title,
-                'link': link,
-                'date': date_text,
-                'author': author,
-                'editor': defaut_editor,
-                'description': page_data['description'],
-                'categories': page_data['categories'],
-                'content': page_data['content'],
-            }
-
-            posts.append(post)
-        logging.info('{} posts found on page'.format(len(posts)))
-
-        # Stack Abuse paginates every 9 posts, this collects the older ones
-        pagination = html.find(
-            'a', {'class': 'border-t-2 border-transparent pt-4 pl-1 inline-flex items-center text-sm font-medium text-gray-500 hover:text-gray-700 hover:border-gray-300'})
-        if pagination is not None:
-            logging.info('Retrieving older posts')
-            return posts + parse_posts(BASE_URL + pagination['href'], defaut_editor)
-        return posts
-    else:
-        logging.error('Could not get a response for the link')
-        return []
+    seen = {author_url}
+    next_page = asyncio.create_task(fetch(session, author_url, limiter))
+    try:
+        while next_page is not None:
+            doc = await next_page
+            if doc is None:
+                logging.error('Could not get a response for the link')
+                return
+
+            # Stack Abuse paginates every 9 posts, the older ones are
+            # requested while the articles of this page are scraped
+            older_posts = find_older_posts(doc)
+            next_page = None
+            if older_posts is not None:
+                author_url = BASE_URL + older_posts
+                if author_url in seen:
+                    # A link back to a page already scraped would loop forever
+                    logging.error('{} was already scraped, stopping'.format(
+                        author_url))
+                else:
+                    seen.add(author_url)
+                    logging.info('Retrieving older posts')
+                    logging.info('Scraping {}'.format(author_url))
+                    next_page = asyncio.create_task(
+                        fetch(session, author_url, limiter))
+
+            articles = []
+            for article in ARTICLES(doc):
+                article_details = ARTICLE_LINK(article)[0]
+                title = ARTICLE_TITLE(article_details)[0].text_content().strip()
+                link = BASE_URL + article_details.get('href')
+                date_text = ARTICLE_DATE(article)[0].get('datetime').strip()
+                author = ARTICLE_AUTHOR(article)[0].text_content().strip()
+                articles.append((title, link, date_text, author))
+            logging.info('{} posts found on page'.format(len(articles)))
+
+            # Article pages are fetched concurrently, the limiter keeps the
+            # requests made to Stack Abuse polite
+            tasks = [parse_page(session, link, limiter, cache)
+                     for _, link, _, _ in articles]
+            pages = await asyncio.gather(*tasks)
+
+            for (title, link, date_text, author), page_data in zip(articles, pages):
+                logging.debug(page_data)
 
+                yield {
+                    'title': title,
+                    'link': link,
+                    'date': date_text,
+                    'author': author,
+                    'editor': defaut_editor,
+                    'description': page_data['description'],
+                    'categories': page_data['categories'],
+                    'content': page_data['content'],
+                }
+    finally:
+        # Don't leave a prefetch running if the caller stops early
+        if next_page is not None:
+            next_page.cancel()
 
-def get_posts_json(filename, author_url, defaut_editor):
+
+async def get_posts_json(filename, posts):
     '''Dumps JSON for stack abuse articles'''
-    posts = parse_posts(author_url, defaut_editor)
-    logging.info('Retrieved {} posts'.format(len(posts)))
-    with open(filename, 'w') as json_file:
-        json.dump(posts, json_file, indent=4)
+    count = 0
+    with open(filename, 'wb') as json_file:
+        # Posts are written as they are scraped, nested as an indented array
+        json_file.write(b'[')
+        async for post in posts:
+            json_file.write(b',\n  ' if count else b'\n  ')
+            json_file.write(orjson.dumps(
+                post, option=orjson.OPT_INDENT_2).replace(b'\n', b'\n  '))
+            count += 1
+        json_file.write(b'\n]' if count else b']')
+    logging.info('Retrieved {} posts'.format(count))
 
 
-def get_posts_csv(filename, author_url, defaut_editor):
+async def get_posts_csv(filename, posts):
     '''Saves CSV file for stack abuse articles'''
-    posts = parse_posts(author_url, defaut_editor)
-    logging.info('Retrieved {} posts'.format(len(posts)))
+    count = 0
     headers = ['Title', 'Link', 'Date']
     with open(filename, 'w') as csv_file:
         csv_writer = csv.writer(csv_file, delimiter=',', quoting=csv.QUOTE_ALL)
         csv_writer.writerow(headers)
-        for post in posts:
+        async for post in posts:
             csv_writer.writerow([post['title'], post['link'], post['date']])
+            count += 1
+    logging.info('Retrieved {} posts'.format(count))
 
 
-def get_posts_markdown(author_url, defaut_editor):
+async def get_posts_markdown(posts):
     '''Saves posts as markdown files to work in Hexo'''
-    posts = parse_posts(author_url, defaut_editor)
-    logging.info('Retrieved {} posts'.format(len(posts)))
+    count = 0
     pathlib.Path('articles').mkdir(exist_ok=True)
-    for post in posts:
+    async for post in posts:
         post_slug = slugify(post['title'])
         with open('articles/{}.md'.format(post_slug), 'w') as f:
-            f.writelines([
-                '---\n',
-                'title: "{}"\n'.format(post['title']),
-                'date: {}\n'.format(post['date']),
-                'link: {}\n'.format(post['link']),
-                'author: {}\n'.format(post['author']),
-                'editor: {}\n'.format(post['editor']),
-                'description'': "{}"\n'.format(post['description']),
-                'tags'': [{}]\n'.format(', '.join(post['categories'])),
-                '---\n\n',
-                '{}\n'.format(post['content']),
-            ])
+            f.write(MARKDOWN_TEMPLATE.format(
+                tags=', '.join(post['categories']), **post))
+        count += 1
+    logging.info('Retrieved {} posts'.format(count))
+
+
+async def main_async(args, author, rate, concurrency, cache):
+    '''Scrapes the author's posts in the output format selected, returns
+    them when they are printed instead of saved'''
+    author_url = '{}/author/{}/'.format(BASE_URL, author)
+    # Each author gets their own files when several are scraped at once
+    if len(args.authors) > 1:
+        filename = 'stackabuse_articles_{}'.format(author)
+    else:
+        filename = 'stackabuse_articles'
+
+    limiter = AsyncRateLimiter(rate, concurrency)
+    # A single session reuses TCP/TLS connections across every page fetched
+    connector = aiohttp.TCPConnector(limit_per_host=POOL_SIZE)
+    result = None
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        posts = parse_posts(session, author_url, args.editor, limiter, cache)
+        # Determine output format
+        if args.csv:
+            await get_posts_csv(filename + '.csv', posts)
+        elif args.json:
+            await get_posts_json(filename + '.json', posts)
+        elif args.markdown:
+            await get_posts_markdown(posts)
+        else:
+            result = [post async for post in posts]
+    return result
+
+
+def scrape_author(args, log_level, rate, concurrency, cache, author):
+    '''Scrapes one author with its own event loop and HTTP session, so it
+    can run in a worker process. Returns the printed posts, if any, and the
+    cache entries it added or replaced'''
+    logging.basicConfig(filename='stackabuse_scraper.log', level=log_level)
+    # parse_page stores a new entry for every page it downloads, entries
+    # revalidated with a 304 are left as they were
+    given = dict(cache)
+    result = asyncio.run(main_async(args, author, rate, concurrency, cache))
+    changes = {url: entry for url, entry in cache.items()
+               if given.get(url) is not entry}
+    return result, changes
 
 
 def main():
     '''Argument parser for scraper'''
     parser = ArgumentParser(description='Web scraper for Stack Abuse writers')
     parser.add_argument('-a', '--author', dest='author',
-                        help='Writer whose articles you want', required=True)
+                        help='Writers whose articles you want, separated by commas',
+                        required=True)
 
     parser.add_argument('-e', '--editor', dest='editor',
-                        help='Editor for that author', required=True)
+                        help='Editor for those authors', required=True)
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--csv', action='store_true',
@@ -155,6 +442,7 @@ def main():
     parser.add_argument('-l', '--loglevel', dest='loglevel',
                         help='Select log level', default='info')
     args = parser.parse_args()
+    args.authors = [author.strip() for author in args.author.split(',')]
 
     # Set logging preferences
     if args.loglevel == 'error':
@@ -164,18 +452,30 @@ def main():
     else:
         log_level = logging.INFO
 
-    logging.basicConfig(filename='stackabuse_scraper.log', level=log_level)
-
-    author_url = '{}/author/{}/'.format(BASE_URL, args.author)
-    # Determine output format
-    if args.csv:
-        get_posts_csv('stackabuse_articles.csv', author_url, args.editor)
-    elif args.json:
-        get_posts_json('stackabuse_articles.json', author_url, args.editor)
-    elif args.markdown:
-        get_posts_markdown(author_url, args.editor)
+    # Authors are scraped in parallel processes, one event loop each. The
+    # workers split the rate and concurrency limits so Stack Abuse sees the
+    # same load however many authors are scraped
+    workers = min(len(args.authors), os.cpu_count() or 1)
+    # Only this process reads and writes the cache file, the workers get a
+    # copy and hand back only the entries they scraped
+    cache = load_cache(CACHE_FILE)
+    scrape = functools.partial(
+        scrape_author, args, log_level,
+        RATE_LIMIT / workers, max(1, CONCURRENCY // workers), cache)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(scrape, args.authors))
     else:
-        print(json.dumps(parse_posts(author_url)))
+        results = [scrape(author) for author in args.authors]
+
+    printed = []
+    for posts, changes in results:
+        cache.update(changes)
+        if posts is not None:
+            printed.extend(posts)
+    if not (args.csv or args.json or args.markdown):
+        print(orjson.dumps(printed).decode())
+    save_cache(CACHE_FILE, cache)
 
 
 if __name__ == '__main__':